@@ -4,8 +4,11 @@ from .keygenerator import TupleKeyGenerator
 from .storage import BaseStorage
 from .storage import LruStorage
 from .storage import ExpiringStorage
+from .storage import CompressedStorage
 from .storage import CacheMissingError
 
+from .registry import CacheRegistry
+
 from .wrapper import memorize_wrapper
 from .wrapper import expiring_memoize
 from .wrapper import lru_memoize
@@ -17,8 +20,11 @@ __all__ = (
     'BaseStorage',
     'LruStorage',
     'ExpiringStorage',
+    'CompressedStorage',
     'CacheMissingError',
 
+    'CacheRegistry',
+
     'memorize_wrapper',
     'expiring_memoize',
     'lru_memoize',
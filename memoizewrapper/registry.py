@@ -0,0 +1,213 @@
+import collections
+import math
+import threading
+import weakref
+
+from . import storage
+
+
+class CacheRegistry(object):
+    """ A registry sharing one budget among several storages, usually one per process.
+
+        Storages keep their own capacity/expiration. On top of that, whenever a registered storage
+        is set, the registry checks the total number of entries against max_entries and evicts from
+        the least valuable storage until the budget is met. Thus busy caches grow at the cost of
+        idle ones.
+
+        The value of a storage is its recent hits per stored entry, i.e. what one entry of it earns.
+        To estimate what more entries would earn, the registry remembers the last ghost_entries keys
+        it evicted from each storage. A key set again while it is remembered is a ghost hit: a miss
+        which a bigger share would have saved, and it counts as a hit. So a thrashing cache takes
+        budget from an idle one, while a cache which only sees new keys does not. Hits are decayed
+        by half every decay_interval sets, so the allocation follows the traffic. The entry just set
+        is never evicted by the registry, so a cold cache keeps at least one entry to earn hits with.
+
+        Optionally, rss_getter is a callable returning the current memory usage in bytes (e.g. the
+        RSS read from /proc/self/statm or psutil). Every memory_check_interval sets, if the usage is
+        above rss_limit, pressure_release_ratio of all entries are evicted, the least valuable
+        first. release_memory() can also be called explicitly.
+
+        :type _storages: weakref.WeakSet
+        :type _hits_baseline: weakref.WeakKeyDictionary
+        :type _ghosts: weakref.WeakKeyDictionary
+        :type _ghost_hits: weakref.WeakKeyDictionary
+    """
+
+    def __init__(self,
+                 max_entries=None,
+                 rss_limit=None,
+                 rss_getter=None,
+                 memory_check_interval=1000,
+                 pressure_release_ratio=0.1,
+                 decay_interval=10000,
+                 ghost_entries=1000):
+        """
+
+        :param max_entries: max number of entries in all registered storages. None means no limit
+        :type max_entries: int
+        :param rss_limit: memory usage in bytes, above which entries are released
+        :type rss_limit: int
+        :param rss_getter: a callable returning the current memory usage in bytes
+        :type rss_getter: callable
+        :param memory_check_interval: check the memory usage once per this number of sets
+        :type memory_check_interval: int
+        :param pressure_release_ratio: ratio of entries to release under memory pressure
+        :type pressure_release_ratio: float
+        :param decay_interval: halve the recorded hits once per this number of sets
+        :type decay_interval: int
+        :param ghost_entries: number of evicted keys remembered per storage
+        :type ghost_entries: int
+        :return:
+        """
+        if max_entries is not None and max_entries <= 0:
+            raise ValueError('max_entries must be a positive integer/long.')
+        if (rss_limit is None) != (rss_getter is None):
+            raise ValueError('rss_limit and rss_getter must be given together.')
+        if memory_check_interval <= 0 or decay_interval <= 0:
+            raise ValueError('Intervals must be positive integers/longs.')
+        if ghost_entries < 0:
+            raise ValueError('ghost_entries must be a non-negative integer/long.')
+        if not 0 < pressure_release_ratio <= 1:
+            raise ValueError('pressure_release_ratio must be in (0, 1].')
+
+        self._max_entries = max_entries
+        self._rss_limit = rss_limit
+        self._rss_getter = rss_getter
+        self._memory_check_interval = memory_check_interval
+        self._pressure_release_ratio = pressure_release_ratio
+        self._decay_interval = decay_interval
+        self._ghost_entries = ghost_entries
+
+        # registry lock is always taken before storage locks, never after
+        self._lock = threading.RLock()
+
+        self._storages = weakref.WeakSet()
+
+        # hits of each storage which are considered old. recent hits = storage.hits - baseline
+        self._hits_baseline = weakref.WeakKeyDictionary()
+
+        # recently evicted keys of each storage, and how many of them were set again (decayed)
+        self._ghosts = weakref.WeakKeyDictionary()
+        self._ghost_hits = weakref.WeakKeyDictionary()
+
+        self._sets = 0
+
+    def register(self, storage_ins):
+        """ register a storage to the registry
+
+        :param storage_ins:
+        :type storage_ins: storage.BaseStorage
+        :return:
+        """
+        if not isinstance(storage_ins, storage.BaseStorage):
+            raise TypeError('Storage must be a sub-class of BaseStorage')
+
+        with self._lock:
+            if storage_ins._registry is not None and storage_ins._registry is not self:
+                raise ValueError('Storage was registered to another registry')
+            storage_ins._registry = self
+            self._storages.add(storage_ins)
+            self._hits_baseline[storage_ins] = storage_ins.hits
+            self._ghosts[storage_ins] = collections.OrderedDict()
+            self._ghost_hits[storage_ins] = 0.0
+
+    def unregister(self, storage_ins):
+        with self._lock:
+            self._storages.discard(storage_ins)
+            self._hits_baseline.pop(storage_ins, None)
+            self._ghosts.pop(storage_ins, None)
+            self._ghost_hits.pop(storage_ins, None)
+            storage_ins._registry = None
+
+    @property
+    def size(self):
+        """ number of entries in all registered storages
+        """
+        with self._lock:
+            return sum(storage_ins.size for storage_ins in self._storages)
+
+    def on_set(self, storage_ins, key):
+        """ Called by a registered storage after data was set into it.
+
+        :param storage_ins:
+        :type storage_ins: storage.BaseStorage
+        :param key: the key just set
+        :return:
+        """
+        with self._lock:
+            self._sets += 1
+
+            ghost = self._ghosts.get(storage_ins)
+            if ghost is not None and ghost.pop(key, None) is not None:
+                self._ghost_hits[storage_ins] += 1
+
+            if self._sets % self._decay_interval == 0:
+                self._decay()
+
+            if self._max_entries is not None:
+                self._evict(self.size - self._max_entries, protected=storage_ins)
+
+            if self._rss_getter is not None and self._sets % self._memory_check_interval == 0:
+                self.release_memory()
+
+    def release_memory(self):
+        """ Evict pressure_release_ratio of all entries if the memory usage is above rss_limit.
+
+        :return: number of evicted entries
+        """
+        if self._rss_getter is None:
+            raise ValueError('No rss_getter was given.')
+
+        with self._lock:
+            if self._rss_getter() <= self._rss_limit:
+                return 0
+            return self._evict(int(math.ceil(self.size * self._pressure_release_ratio)))
+
+    def _value(self, storage_ins):
+        """ recent hits and ghost hits per entry of a storage
+
+        :type storage_ins: storage.BaseStorage
+        :return: float
+        """
+        recent_hits = storage_ins.hits - self._hits_baseline.get(storage_ins, 0)
+        return (recent_hits + self._ghost_hits.get(storage_ins, 0.0)) / max(storage_ins.size, 1)
+
+    def _decay(self):
+        for storage_ins in self._storages:
+            baseline = self._hits_baseline.get(storage_ins, 0)
+            self._hits_baseline[storage_ins] = baseline + (storage_ins.hits - baseline) // 2
+            self._ghost_hits[storage_ins] = self._ghost_hits.get(storage_ins, 0.0) / 2
+
+    def _remember_evicted(self, storage_ins, key):
+        ghost = self._ghosts.get(storage_ins)
+        if ghost is None or key is None or not self._ghost_entries:
+            return
+        ghost[key] = True
+        if len(ghost) > self._ghost_entries:
+            ghost.popitem(last=False)
+
+    def _evict(self, count, protected=None):
+        """ Evict count entries, from the least valuable storage first.
+
+        :param count:
+        :param protected: a storage whose last entry, i.e. the one just set, is not evicted
+        :type protected: storage.BaseStorage
+        :return: number of evicted entries
+        """
+        evicted = 0
+        while evicted < count:
+            candidates = [storage_ins for storage_ins in self._storages
+                          if storage_ins.size > (1 if storage_ins is protected else 0)]
+            if not candidates:
+                break
+
+            # the bigger one goes first if values are the same
+            victim = min(candidates, key=lambda storage_ins: (self._value(storage_ins), -storage_ins.size))
+            try:
+                key = victim.evict()
+            except storage.CacheMissingError:
+                # emptied by another thread
+                continue
+            self._remember_evicted(victim, key)
+            evicted += 1
+        return evicted
@@ -1,7 +1,18 @@
 import collections
 import copy
+import pickle
 import threading
 import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    # python built without liblzma
+    lzma = None
+
+# CPU time of the calling thread. time.thread_time() is only available since 3.7
+_cpu_time = getattr(time, 'thread_time', time.process_time)
 
 
 class CacheMissingError(Exception):
@@ -25,6 +36,18 @@ class BaseStorage(object):
         """
         self.deepcopy = deepcopy
 
+        # secondary index between tags and keys. Sub-classes maintain it under their own lock,
+        # so that invalidate() costs time proportional to the number of tagged keys.
+        self._tag_keys = {}
+        self._key_tags = {}
+
+        # access counters, maintained by sub-classes under their own lock
+        self._hits = 0
+        self._misses = 0
+
+        # set by registry.CacheRegistry.register()
+        self._registry = None
+
     def get(self, key):
         """ Get data from storage
 
@@ -34,12 +57,15 @@ class BaseStorage(object):
         """
         raise NotImplementedError()
 
-    def set(self, key, value):
+    def set(self, key, value, tags=()):
         """ Set data into storage
 
         :param key: storage key
         :param value: data value
+        :param tags: hashable tags attached to the key, used by invalidate()
+        :type tags: collections.Iterable
         :return:
+        :raises: TypeError if a tag is unhashable, in which case nothing is stored
         """
         raise NotImplementedError()
 
@@ -50,6 +76,23 @@ class BaseStorage(object):
         :return:
         """
 
+    def evict(self):
+        """ Delete the least valuable data from storage. Used by registry.CacheRegistry.
+
+        :return: key of the deleted data, or None if only expired data was deleted
+        :raises: CacheMissingError if the storage is empty
+        """
+        raise NotImplementedError()
+
+    def invalidate(self, tag):
+        """ Delete all data tagged with tag
+
+        :param tag: a tag given to set()
+        :return: number of deleted keys
+        :rtype: int
+        """
+        raise NotImplementedError()
+
     def flush(self):
         """ Flush the data in the storage
 
@@ -57,6 +100,65 @@ class BaseStorage(object):
         """
         raise NotImplementedError()
 
+    @property
+    def size(self):
+        raise NotImplementedError()
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def _notify_registry_set(self, key):
+        """ Let the registry enforce its budget. Must be called without holding the storage lock,
+            since the registry may evict from this storage.
+
+        :param key: the key just set
+        :return:
+        """
+        if self._registry is not None:
+            self._registry.on_set(self, key)
+
+    def _index_tags(self, key, tags):
+        """ Replace the tags of key in the tag index. Caller must hold the storage lock.
+
+        :param key:
+        :param tags:
+        :type tags: frozenset
+        :return:
+        """
+        self._unindex_tags(key)
+
+        if not tags:
+            return
+
+        self._key_tags[key] = tags
+        for tag in tags:
+            self._tag_keys.setdefault(tag, set()).add(key)
+
+    def _unindex_tags(self, key):
+        """ Remove key from the tag index. Caller must hold the storage lock.
+
+        :param key:
+        :return:
+        """
+        tags = self._key_tags.pop(key, None)
+        if tags is None:
+            return
+
+        for tag in tags:
+            keys = self._tag_keys[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tag_keys[tag]
+
+    def _flush_tags(self):
+        self._tag_keys.clear()
+        self._key_tags.clear()
+
 
 class ExpiringStorage(BaseStorage):
     """ Use a dict object as the storage and provides simple functionality.
@@ -70,9 +172,12 @@ class ExpiringStorage(BaseStorage):
 
     def __init__(self, *args, **kwargs):
         self._expiration = kwargs.pop('expiration', None)
+        # a callable returning the current time, replaced when traces are replayed
+        self._clock = kwargs.pop('clock', time.time)
         super(ExpiringStorage, self).__init__(*args, **kwargs)
 
-        self._cache = {}
+        # ordered by set time. Since all data lives as long, it is ordered by expiration as well
+        self._cache = collections.OrderedDict()
         self._lock = threading.Lock()
 
     def get(self, key):
@@ -86,27 +191,38 @@ class ExpiringStorage(BaseStorage):
         """
         with self._lock:
             if key not in self._cache:
+                self._misses += 1
                 raise CacheMissingError()
 
             stored_data = self._cache[key]
-            if stored_data.expiration is not None and stored_data.expiration < time.time():
+            if stored_data.expiration is not None and stored_data.expiration < self._clock():
                 del self._cache[key]
+                self._unindex_tags(key)
+                self._misses += 1
                 raise CacheMissingError()
+            self._hits += 1
             return stored_data.value if not self.deepcopy else copy.deepcopy(stored_data.value)
 
-    def set(self, key, value):
+    def set(self, key, value, tags=()):
         """ Set a (key, value) pair into the storage.
 
         :param key:
         :param value:
+        :param tags:
         :return:
         """
 
+        # raises TypeError for unhashable tags before anything is stored
+        tags = frozenset(tags)
         if self.deepcopy:
             value = copy.deepcopy(value)
-        expiration = time.time() + self._expiration if self._expiration is not None else None
+        expiration = self._clock() + self._expiration if self._expiration is not None else None
         with self._lock:
+            # re-set data goes to the end, to keep the order by expiration
+            self._cache.pop(key, None)
             self._cache[key] = self._StoredData(expiration, value)
+            self._index_tags(key, tags)
+        self._notify_registry_set(key)
 
     def delete(self, key):
         """ remove data by key
@@ -120,10 +236,56 @@ class ExpiringStorage(BaseStorage):
                 del self._cache[key]
             except KeyError:
                 raise CacheMissingError()
+            self._unindex_tags(key)
+
+    def evict(self):
+        """ remove all expired data. If nothing was expired, remove the earliest set data.
+
+        :return: key of the removed data, or None if only expired data was removed
+        :raises: CacheMissingError
+        """
+        with self._lock:
+            if not self._cache:
+                raise CacheMissingError()
+
+            now = self._clock()
+            key, stored_data = next(iter(self._cache.items()))
+            if stored_data.expiration is None or stored_data.expiration >= now:
+                del self._cache[key]
+                self._unindex_tags(key)
+                return key
+
+            # expired data are at the beginning
+            while self._cache:
+                key, stored_data = next(iter(self._cache.items()))
+                if stored_data.expiration >= now:
+                    break
+                del self._cache[key]
+                self._unindex_tags(key)
+
+    def invalidate(self, tag):
+        """ remove all data tagged with tag, expired or not
+
+        :param tag:
+        :return: number of removed keys
+        """
+        with self._lock:
+            keys = list(self._tag_keys.get(tag, ()))
+            for key in keys:
+                del self._cache[key]
+                self._unindex_tags(key)
+            return len(keys)
 
     def flush(self):
         with self._lock:
             self._cache.clear()
+            self._flush_tags()
+
+    @property
+    def size(self):
+        """ number of stored data, including expired data which was not cleaned yet
+        """
+        return len(self._cache)
 
 
 class LruStorage(BaseStorage):
@@ -168,12 +330,16 @@ class LruStorage(BaseStorage):
             node = self._data.get(key)
 
             if node is None:
+                self._misses += 1
                 raise CacheMissingError()
 
+            self._hits += 1
             self._dli_touch(node)
             return node.value if not self.deepcopy else copy.deepcopy(node.value)
 
-    def set(self, key, value):
+    def set(self, key, value, tags=()):
+        # raises TypeError for unhashable tags before anything is stored
+        tags = frozenset(tags)
         if self.deepcopy:
             value = copy.deepcopy(value)
 
@@ -184,10 +350,7 @@ class LruStorage(BaseStorage):
                 # it is a new key to set
                 if self._capacity <= self._size:
                     # we hit the floor, remove one node from the storage
-                    node_to_remove = self._head.left
-                    self._dli_remove_node(node_to_remove)
-                    del self._data[node_to_remove.key]
-                    self._size -= 1
+                    self._remove_data_node(self._head.left)
 
                 node = self._DataNode(key, value)
                 self._dli_push_front(node)
@@ -200,6 +363,9 @@ class LruStorage(BaseStorage):
                 node.value = value
                 self._dli_touch(node)
 
+            self._index_tags(key, tags)
+        self._notify_registry_set(key)
+
     def delete(self, key):
         with self._lock:
             node = self._data.get(key)
@@ -207,9 +373,27 @@ class LruStorage(BaseStorage):
             if node is None:
                 raise CacheMissingError()
 
-            self._dli_remove_node(node)
-            del self._data[key]
-            self._size -= 1
+            self._remove_data_node(node)
+
+    def evict(self):
+        """ remove the least recently used data
+
+        :return: key of the removed data
+        :raises: CacheMissingError
+        """
+        with self._lock:
+            if self._head is None:
+                raise CacheMissingError()
+            node = self._head.left
+            self._remove_data_node(node)
+            return node.key
+
+    def invalidate(self, tag):
+        with self._lock:
+            keys = list(self._tag_keys.get(tag, ()))
+            for key in keys:
+                self._remove_data_node(self._data[key])
+            return len(keys)
 
     def flush(self):
         """ flush() on a Lru storage is a quite expensive, to avoid cycled memory garbage.
@@ -223,11 +407,22 @@ class LruStorage(BaseStorage):
             self._data.clear()
             self._head = None
             self._size = 0
+            self._flush_tags()
 
     @property
     def size(self):
         return self._size
 
+    def _remove_data_node(self, node):
+        """ Remove a node from both the hash table and the linked list, and drop its tags.
+
+        :type node: _DataNode
+        """
+        self._dli_remove_node(node)
+        del self._data[node.key]
+        self._unindex_tags(node.key)
+        self._size -= 1
+
     def _dli_remove_node(self, node):
         """ Remove a node from linked list
 
@@ -261,3 +456,153 @@ class LruStorage(BaseStorage):
 
         self._dli_remove_node(node)
         self._dli_push_front(node)
+
+
+class CompressedStorage(BaseStorage):
+    """ CompressedStorage wraps another storage. Values whose pickles are bigger than a threshold are
+        stored compressed, and are decompressed by get(). Smaller values are stored as they are.
+
+        It trades CPU time on sets and hits for memory. Both sides are reported: compression_ratio,
+        compress_time and decompress_time, in CPU seconds of the calling threads.
+
+        Values which cannot be pickled, or do not shrink when compressed, are stored as they are.
+    """
+
+    _CODECS = {
+        'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress),
+    }
+
+    _DEFAULT_LEVELS = {
+        'zlib': zlib.Z_DEFAULT_COMPRESSION,
+    }
+
+    if lzma is not None:
+        _CODECS['lzma'] = (lambda data, level: lzma.compress(data, preset=level), lzma.decompress)
+        _DEFAULT_LEVELS['lzma'] = lzma.PRESET_DEFAULT
+
+    class _CompressedValue(object):
+        """ A nested data class, marking compressed values in the wrapped storage
+        """
+
+        __slots__ = ('data',)
+
+        def __init__(self, data):
+            self.data = data
+
+    def __init__(self, storage_ins, threshold=1024, codec='zlib', level=None):
+        """ init
+
+        :param storage_ins: the wrapped storage. Its deepcopy also applies to uncompressed values
+        :type storage_ins: BaseStorage
+        :param threshold: pickles bigger than this number of bytes are compressed
+        :type threshold: int
+        :param codec: 'zlib' or 'lzma', if python was built with lzma
+        :type codec: basestring
+        :param level: compression level of zlib, or preset of lzma. None means the codec's default
+        :type level: int
+        :return:
+        """
+        if not isinstance(storage_ins, BaseStorage):
+            raise TypeError('Storage must be a sub-class of BaseStorage')
+        if codec not in self._CODECS:
+            raise ValueError('Codec must be one of %s.' % ', '.join(sorted(self._CODECS)))
+
+        super(CompressedStorage, self).__init__(deepcopy=storage_ins.deepcopy)
+        self._storage = storage_ins
+        self._threshold = threshold
+        self._compress, self._decompress = self._CODECS[codec]
+        self._level = level if level is not None else self._DEFAULT_LEVELS[codec]
+
+        # fail now rather than at the first set()
+        try:
+            self._compress(b'', self._level)
+        except Exception:
+            raise ValueError('Invalid compression level %r for %s.' % (level, codec))
+
+        self._lock = threading.Lock()
+        self._raw_bytes = 0
+        self._compressed_bytes = 0
+        self._compress_time = 0.0
+        self._decompress_time = 0.0
+
+    def get(self, key):
+        value = self._storage.get(key)
+        if not isinstance(value, self._CompressedValue):
+            return value
+
+        start = _cpu_time()
+        value = pickle.loads(self._decompress(value.data))
+        elapsed = _cpu_time() - start
+
+        with self._lock:
+            self._decompress_time += elapsed
+        return value
+
+    def set(self, key, value, tags=()):
+        tags = frozenset(tags)
+        start = _cpu_time()
+        raw_bytes, compressed_bytes = 0, 0
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # e.g. locks, generators or lambdas
+            data = None
+
+        if data is not None and len(data) > self._threshold:
+            compressed_data = self._compress(data, self._level)
+            # incompressible data, e.g. already compressed, would only cost a decompression per hit
+            if len(compressed_data) < len(data):
+                value = self._CompressedValue(compressed_data)
+                raw_bytes, compressed_bytes = len(data), len(compressed_data)
+        elapsed = _cpu_time() - start
+
+        with self._lock:
+            self._raw_bytes += raw_bytes
+            self._compressed_bytes += compressed_bytes
+            self._compress_time += elapsed
+
+        self._storage.set(key, value, tags)
+        self._notify_registry_set(key)
+
+    def delete(self, key):
+        self._storage.delete(key)
+
+    def evict(self):
+        return self._storage.evict()
+
+    def invalidate(self, tag):
+        return self._storage.invalidate(tag)
+
+    def flush(self):
+        self._storage.flush()
+
+    @property
+    def size(self):
+        return self._storage.size
+
+    @property
+    def hits(self):
+        return self._storage.hits
+
+    @property
+    def misses(self):
+        return self._storage.misses
+
+    @property
+    def compression_ratio(self):
+        """ raw bytes / compressed bytes of all compressed values ever set. 1.0 if nothing was compressed
+        """
+        with self._lock:
+            return float(self._raw_bytes) / self._compressed_bytes if self._compressed_bytes else 1.0
+
+    @property
+    def compress_time(self):
+        """ CPU seconds spent in set(), pickling all values and compressing the big ones
+        """
+        return self._compress_time
+
+    @property
+    def decompress_time(self):
+        """ CPU seconds spent in decompressing and unpickling values
+        """
+        return self._decompress_time
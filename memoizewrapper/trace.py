@@ -0,0 +1,271 @@
+""" Record cache accesses and replay them to tune capacity/expiration.
+
+    Record:
+
+        recorder = trace.TraceRecorder('/tmp/query_card_name.trace', sample_rate=0.1)
+
+        @lru_memoize(('card_id',), 1000, trace_recorder=recorder)
+        def query_card_name(card_id):
+            ...
+
+    Records are buffered, and written when the recorder is closed, or at the latest at the interpreter
+    exit. Call recorder.close(), or use the recorder as a context manager, to write them earlier.
+
+    Replay:
+
+        python -m memoizewrapper.trace /tmp/query_card_name.trace --capacity 100 1000 10000 --expiration 10 60
+
+    Use one recorder per decorated function, since keys of different functions are not distinguishable.
+"""
+import argparse
+import atexit
+import collections
+import hashlib
+import pickle
+import struct
+import sys
+import threading
+import time
+
+from . import storage
+
+
+_MAGIC = b'MWTR'
+_VERSION = 1
+# magic, version, sample rate
+_HEADER = struct.Struct('<4sBd')
+# timestamp, key hash, hit, compute time
+_RECORD = struct.Struct('<dQBd')
+
+# keys are sampled by their hashes, so that either all or none of the accesses of a key are recorded
+_SAMPLE_SPACE = 1 << 24
+
+TraceRecord = collections.namedtuple('TraceRecord', ('timestamp', 'key_hash', 'hit', 'compute_time'))
+
+SimulationResult = collections.namedtuple('SimulationResult', ('storage', 'parameter', 'requests', 'misses',
+                                                               'miss_ratio', 'saved_compute_time'))
+
+
+def key_hash(key):
+    """ 64 bits hash of a storage key.
+
+    :param key: storage key. Keys of TupleKeyGenerator are md5 hex digests, which are used as they are.
+        Other keys are hashed by md5, so that they are uniform for sampling
+    :return: int
+    """
+    if isinstance(key, str) and len(key) == 32:
+        try:
+            return int(key[:16], 16)
+        except ValueError:
+            pass
+    return int(hashlib.md5(pickle.dumps(key)).hexdigest()[:16], 16)
+
+
+class TraceRecorder(object):
+    """ Append sampled cache accesses to a binary trace file.
+
+        Every record takes 25 bytes. With sample_rate, only the given fraction of keys are recorded,
+        which keeps both the overhead and the file small while miss ratios stay representative.
+    """
+
+    def __init__(self, path, sample_rate=1.0, buffer_size=4096):
+        """
+
+        :param path: trace file path. An existing trace is truncated
+        :type path: basestring
+        :param sample_rate: fraction of keys to record, in (0, 1]
+        :type sample_rate: float
+        :param buffer_size: number of records buffered in memory before written
+        :type buffer_size: int
+        :return:
+        """
+        if not 0 < sample_rate <= 1:
+            raise ValueError('sample_rate must be in (0, 1].')
+
+        self.sample_rate = sample_rate
+        self._sample_threshold = int(sample_rate * _SAMPLE_SPACE)
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self._lock = threading.Lock()
+
+        self._file = open(path, 'wb')
+        self._file.write(_HEADER.pack(_MAGIC, _VERSION, sample_rate))
+
+        # buffered records would be lost at exit otherwise
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def record(self, key, hit, compute_time=0.0):
+        """ record an access
+
+        :param key: storage key
+        :param hit: if the cache was hit
+        :type hit: bool
+        :param compute_time: seconds spent in the decorated function on a miss
+        :type compute_time: float
+        :return:
+        """
+        hashed_key = key_hash(key)
+        if hashed_key % _SAMPLE_SPACE >= self._sample_threshold:
+            return
+
+        with self._lock:
+            if self._file is None:
+                return
+            self._buffer.append(_RECORD.pack(time.time(), hashed_key, hit, compute_time))
+            if len(self._buffer) >= self._buffer_size:
+                self._flush_buffer()
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._flush_buffer()
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._flush_buffer()
+            self._file.close()
+            self._file = None
+        atexit.unregister(self.close)
+
+    def _flush_buffer(self):
+        self._file.write(b''.join(self._buffer))
+        del self._buffer[:]
+
+
+def read_trace(path):
+    """ read a trace file
+
+    :param path:
+    :return: (sample rate, list of TraceRecord)
+    """
+    with open(path, 'rb') as trace_file:
+        header = trace_file.read(_HEADER.size)
+        if len(header) != _HEADER.size:
+            raise ValueError('%s is not a trace file' % path)
+        magic, version, sample_rate = _HEADER.unpack(header)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('%s is not a trace file' % path)
+
+        data = trace_file.read()
+
+    # ignore a truncated last record, e.g. the process was killed while writing
+    data = data[:len(data) - len(data) % _RECORD.size]
+    records = [TraceRecord(timestamp, hashed_key, bool(hit), compute_time)
+               for timestamp, hashed_key, hit, compute_time in _RECORD.iter_unpack(data)]
+    return sample_rate, records
+
+
+def _simulate(records, compute_time, storage_ins, clock):
+    """ replay records through a storage
+
+    :param records: list of TraceRecord
+    :param compute_time: dict of key hash: compute time
+    :param storage_ins: an empty storage
+    :type storage_ins: storage.BaseStorage
+    :param clock: a one-element list whose item is set to the timestamp of the replayed record
+    :type clock: list
+    :return: (requests, misses, saved compute time)
+    """
+    misses = 0
+    saved_compute_time = 0.0
+    for record in records:
+        clock[0] = record.timestamp
+        try:
+            storage_ins.get(record.key_hash)
+        except storage.CacheMissingError:
+            misses += 1
+            storage_ins.set(record.key_hash, None)
+        else:
+            saved_compute_time += compute_time[record.key_hash]
+    return len(records), misses, saved_compute_time
+
+
+def miss_ratio_curve(path, capacities=(), expirations=(), storage_factories=None):
+    """ replay a trace through LruStorage of each capacity, ExpiringStorage of each expiration
+        and storages made by storage_factories.
+
+        Capacities are scaled by the sample rate of the trace, so they are comparable to the real
+        cache. Saved compute time is scaled back likewise. Compute time of a key is estimated by its
+        recorded misses, or by the mean of all misses if it was never missed in the trace.
+
+    :param path: trace file path
+    :param capacities: capacities of LruStorage to simulate
+    :param expirations: expirations in seconds of ExpiringStorage to simulate
+    :param storage_factories: dict of name: callable(clock) returning a storage. clock is a callable
+        returning the replayed time, which can be given to ExpiringStorage
+    :type storage_factories: dict
+    :return: list of SimulationResult
+    """
+    sample_rate, records = read_trace(path)
+    compute_time = _compute_time_by_key(records)
+
+    simulations = []
+    for capacity in capacities:
+        scaled_capacity = max(1, int(round(capacity * sample_rate)))
+        simulations.append(('LruStorage', capacity,
+                            lambda clock, capacity=scaled_capacity: storage.LruStorage(capacity=capacity)))
+    for expiration in expirations:
+        simulations.append(('ExpiringStorage', expiration,
+                            lambda clock, expiration=expiration: storage.ExpiringStorage(expiration=expiration,
+                                                                                         clock=clock)))
+    for name, storage_factory in sorted((storage_factories or {}).items()):
+        simulations.append((name, None, storage_factory))
+
+    results = []
+    for name, parameter, storage_factory in simulations:
+        now = [0.0]
+        storage_ins = storage_factory(lambda: now[0])
+        requests, misses, saved_compute_time = _simulate(records, compute_time, storage_ins, now)
+        results.append(SimulationResult(name, parameter, int(round(requests / sample_rate)),
+                                        int(round(misses / sample_rate)),
+                                        float(misses) / requests if requests else 0.0,
+                                        saved_compute_time / sample_rate))
+    return results
+
+
+def _compute_time_by_key(records):
+    """ mean compute time of each key
+
+    :param records: list of TraceRecord
+    :return: collections.defaultdict
+    """
+    total = collections.defaultdict(float)
+    count = collections.defaultdict(int)
+    for record in records:
+        if not record.hit:
+            total[record.key_hash] += record.compute_time
+            count[record.key_hash] += 1
+
+    mean = sum(total.values()) / sum(count.values()) if count else 0.0
+    compute_time = collections.defaultdict(lambda: mean)
+    compute_time.update((hashed_key, total[hashed_key] / count[hashed_key]) for hashed_key in total)
+    return compute_time
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate miss ratios of a cache access trace.')
+    parser.add_argument('trace', help='trace file recorded by TraceRecorder')
+    parser.add_argument('--capacity', type=int, nargs='*', default=[], help='LruStorage capacities')
+    parser.add_argument('--expiration', type=float, nargs='*', default=[], help='ExpiringStorage expirations')
+    args = parser.parse_args(argv)
+
+    results = miss_ratio_curve(args.trace, capacities=args.capacity, expirations=args.expiration)
+
+    print('%-16s %12s %12s %12s %10s %16s' % ('storage', 'parameter', 'requests', 'misses', 'miss ratio',
+                                              'saved time (s)'))
+    for result in results:
+        print('%-16s %12s %12d %12d %10.4f %16.3f' % result)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
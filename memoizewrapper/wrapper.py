@@ -1,4 +1,8 @@
+import copy
 import functools
+import inspect
+import itertools
+import time
 
 from . import keygenerator
 from . import storage
@@ -9,13 +13,19 @@ class _MemoizeStorageManager(object):
         :type _key_generator: keygenerator.BaseKeyGenerator
         :type _storage: storage.BaseStorage
         :type _escape_cache_if:
+        :type _tag_template: tuple
+        :type _tag_generator:
     """
 
     def __init__(self,
                  func,
                  key_generator,
                  storage_ins,
-                 escape_cache_if=None):
+                 escape_cache_if=None,
+                 tag_template=(),
+                 tag_generator=None,
+                 registry=None,
+                 trace_recorder=None):
         """
 
         :param func: decorated function
@@ -26,15 +36,29 @@ class _MemoizeStorageManager(object):
         :type storage_ins: storage.BaseStorage
         :param escape_cache_if: do not cache if the return value is True
         :type escape_cache_if:
+        :param tag_template: names of parameters to tag the cache with, as (name, value) tags
+        :type tag_template: tuple
+        :param tag_generator: a callable taking the return value and returning an iterable of tags,
+            e.g. a list. Returning a string raises TypeError
+        :type tag_generator:
+        :param registry: a registry to share the budget with other storages
+        :type registry: registry.CacheRegistry
+        :param trace_recorder: a recorder of cache accesses
+        :type trace_recorder: trace.TraceRecorder
         :return:
 
         """
         if not isinstance(key_generator, keygenerator.BaseKeyGenerator):
             raise TypeError('Key generator must be a sub-class of BaseKeyGenerator')
-        if not isinstance(storage, storage.BaseStorage):
+        if not isinstance(storage_ins, storage.BaseStorage):
             raise TypeError('Storage must be a sub-class of BaseStorage')
+        if not isinstance(tag_template, tuple):
+            raise TypeError('tag template must be a tuple')
 
         self._func = func
+        # __module__ and __qualname__ also let the manager be pickled by reference, see __reduce__().
+        # __dict__ is not copied, or a stacked manager's attributes would overwrite ours
+        functools.update_wrapper(self, func, updated=())
 
         self._storage = storage_ins
         self._key_generator = key_generator
@@ -43,6 +67,17 @@ class _MemoizeStorageManager(object):
         # use a simple lambda function to avoid None check when use it
         self._escape_cache_if = escape_cache_if if escape_cache_if is not None else lambda x: False
 
+        self._signature = inspect.signature(func, follow_wrapped=True)
+        for tag_arg in tag_template:
+            if tag_arg not in self._signature.parameters:
+                raise ValueError('%s is not a function parameter' % tag_arg)
+        self._tag_template = tag_template
+        self._tag_generator = tag_generator
+        self._trace_recorder = trace_recorder
+
+        if registry is not None:
+            registry.register(storage_ins)
+
     def __call__(self, *args, **kwargs):
         """
 
@@ -57,20 +92,194 @@ class _MemoizeStorageManager(object):
             value = self._storage.get(key)
         except storage.CacheMissingError:
             # cache misses. call the function and reset it.
-            value = self._func(*args, **kwargs)
+            if self._trace_recorder is None:
+                value = self._func(*args, **kwargs)
+            else:
+                compute_start = time.perf_counter()
+                value = self._func(*args, **kwargs)
+                self._trace_recorder.record(key, False, time.perf_counter() - compute_start)
 
             if not self._escape_cache_if(value):
-                self._storage.set(key, value)
+                self._storage.set(key, value, self._generate_tags(args, kwargs, value))
+        else:
+            if self._trace_recorder is not None:
+                self._trace_recorder.record(key, True)
 
         return value
 
+    def _generate_tags(self, args, kwargs, value):
+        """ generate tags of a cache miss. Only called when a value is about to be stored.
+
+        :return: frozenset
+        :raises: TypeError if a tag is unhashable
+        """
+        tags = []
+        if self._tag_template:
+            bound_arguments = self._signature.bind(*args, **kwargs)
+            bound_arguments.apply_defaults()
+            tags.extend((tag_arg, bound_arguments.arguments[tag_arg]) for tag_arg in self._tag_template)
+        if self._tag_generator is not None:
+            generated_tags = self._tag_generator(value)
+            # a string is iterable, but it is surely meant to be one tag rather than characters
+            if isinstance(generated_tags, (str, bytes)):
+                raise TypeError('tag_generator must return an iterable of tags, not a string')
+            tags.extend(generated_tags)
+        # unhashable tags, e.g. a list argument, raise TypeError here rather than after storing
+        return frozenset(tags)
+
     # noinspection PyUnusedLocal
     def __get__(self, obj, obj_type):
-        return functools.partial(self.__call__, obj)
+        if obj is None:
+            return self
+        return _BoundMemoizeStorageManager(self, obj)
+
+    def __reduce__(self):
+        # pickled by reference like a function, so that it can be sent to process pools
+        return self.__qualname__
+
+    def map(self, *iterables, executor=None, chunksize=1):
+        """ like map(my_func, *iterables), but with cache.
+
+            Keys are generated and looked up at once. Hits are served from the storage, duplicated keys
+            are computed only once, and only the unique misses are dispatched to the executor. Results
+            are yielded in order, and stored as they arrive.
+
+            my_func.map(user_ids, executor=concurrent.futures.ThreadPoolExecutor(8))
+
+            A process pool requires the decorated function to be defined at the module level.
+
+        :param iterables: parameters of the decorated function, as in map()
+        :param executor: a concurrent.futures.Executor. If None, misses are computed in this thread
+        :type executor: concurrent.futures.Executor
+        :param chunksize: passed to executor.map()
+        :type chunksize: int
+        :return: iterator of results
+        """
+        if not iterables:
+            raise TypeError('map() must have at least one iterable')
+
+        # list of (key, hit, value) of each call. value is the index in misses_args for misses
+        results = []
+        misses_index = {}
+        misses_args = []
+
+        for args in zip(*iterables):
+            key = self._key_generator.generate_key(*args)
+
+            miss_index = misses_index.get(key)
+            if miss_index is None:
+                try:
+                    results.append((key, True, self._storage.get(key)))
+                except storage.CacheMissingError:
+                    misses_index[key] = len(misses_args)
+                    misses_args.append(args)
+                    results.append((key, False, len(misses_args) - 1))
+            else:
+                results.append((key, False, miss_index))
+
+        if executor is None:
+            computed = map(_call_uncached, itertools.repeat(self, len(misses_args)), misses_args)
+        else:
+            computed = executor.map(_call_uncached, itertools.repeat(self, len(misses_args)), misses_args,
+                                    chunksize=chunksize)
+
+        return self._iter_map_results(results, misses_args, computed)
+
+    def _iter_map_results(self, results, misses_args, computed):
+        """ yield results of map(), storing misses as they are computed.
+            Accesses are traced here, in the order of the calls.
+
+        :return: generator
+        """
+        misses_value = []
+        for key, hit, value in results:
+            if hit:
+                if self._trace_recorder is not None:
+                    self._trace_recorder.record(key, True)
+                yield value
+                continue
+
+            miss_index = value
+            if miss_index < len(misses_value):
+                # a duplicated key, which would have been a hit if called one by one
+                if self._trace_recorder is not None:
+                    self._trace_recorder.record(key, True)
+                value = misses_value[miss_index]
+                yield value if not self._storage.deepcopy else copy.deepcopy(value)
+                continue
+
+            # misses are dispatched in the order of their first occurrences
+            value, compute_time = next(computed)
+            args = misses_args[miss_index]
+            if self._trace_recorder is not None:
+                self._trace_recorder.record(key, False, compute_time)
+            if not self._escape_cache_if(value):
+                self._storage.set(key, value, self._generate_tags(args, {}, value))
+
+            misses_value.append(value)
+            yield value
 
     def flush(self):
         self._storage.flush()
 
+    def invalidate(self, tag=None, **arguments):
+        """ remove cached values by tag, or by parameters in the tag template.
+
+            my_func.invalidate(tag='user:42')
+            my_func.invalidate(user_id=42)
+
+        :param tag: a tag returned by tag_generator
+        :param arguments: parameter values, the parameters must be in tag_template
+        :return: number of removed cached values
+        """
+        for tag_arg in arguments:
+            if tag_arg not in self._tag_template:
+                raise ValueError('%s is not in the tag template' % tag_arg)
+
+        removed = 0
+        if tag is not None:
+            removed += self._storage.invalidate(tag)
+        for tag_arg, value in arguments.items():
+            removed += self._storage.invalidate((tag_arg, value))
+        return removed
+
+
+class _BoundMemoizeStorageManager(object):
+    """ A decorated method bound to an instance, as functools.partial(manager, obj), which also
+        exposes map(), flush() and invalidate() of the manager.
+
+        :type _manager: _MemoizeStorageManager
+    """
+
+    def __init__(self, manager, obj):
+        self._manager = manager
+        self._obj = obj
+
+    def __call__(self, *args, **kwargs):
+        return self._manager(self._obj, *args, **kwargs)
+
+    def map(self, *iterables, **kwargs):
+        if not iterables:
+            raise TypeError('map() must have at least one iterable')
+        return self._manager.map(itertools.repeat(self._obj), *iterables, **kwargs)
+
+    def flush(self):
+        self._manager.flush()
+
+    def invalidate(self, tag=None, **arguments):
+        return self._manager.invalidate(tag, **arguments)
+
+
+def _call_uncached(manager, args):
+    """ call the decorated function without cache. It is at the module level to be sent to process pools.
+
+    :type manager: _MemoizeStorageManager
+    :return: (value, compute time)
+    """
+    compute_start = time.perf_counter()
+    value = manager._func(*args)
+    return value, time.perf_counter() - compute_start
+
 
 def memorize_wrapper(*args, **kwargs):
     def wrapped_manager(func):
@@ -79,17 +288,29 @@ def memorize_wrapper(*args, **kwargs):
     return wrapped_manager
 
 
-def expiring_memoize(key_template, expiration, deepcopy=False, escape_cache_if=None):
+def expiring_memoize(key_template, expiration, deepcopy=False, escape_cache_if=None,
+                     tag_template=(), tag_generator=None, registry=None,
+                     trace_recorder=None):
     return memorize_wrapper(
         keygenerator.TupleKeyGenerator(template=key_template),
         storage.ExpiringStorage(expiration=expiration, deepcopy=deepcopy),
         escape_cache_if=escape_cache_if,
+        tag_template=tag_template,
+        tag_generator=tag_generator,
+        registry=registry,
+        trace_recorder=trace_recorder,
     )
 
 
-def lru_memoize(key_template, capacity, deepcopy=False, escape_cache_if=None):
+def lru_memoize(key_template, capacity, deepcopy=False, escape_cache_if=None,
+                tag_template=(), tag_generator=None, registry=None,
+                trace_recorder=None):
     return memorize_wrapper(
         keygenerator.TupleKeyGenerator(template=key_template),
         storage.LruStorage(capacity=capacity, deepcopy=deepcopy),
         escape_cache_if=escape_cache_if,
+        tag_template=tag_template,
+        tag_generator=tag_generator,
+        registry=registry,
+        trace_recorder=trace_recorder,
     )
@@ -0,0 +1,154 @@
+import unittest
+
+import memoizewrapper.registry
+import memoizewrapper.storage
+import memoizewrapper.wrapper
+
+
+class RegistryTest(unittest.TestCase):
+
+    def test_max_entries(self):
+        registry = memoizewrapper.registry.CacheRegistry(max_entries=4)
+        busy = memoizewrapper.storage.LruStorage(capacity=10)
+        idle = memoizewrapper.storage.ExpiringStorage()
+        registry.register(busy)
+        registry.register(idle)
+
+        idle.set('idle-0', 0)
+        idle.set('idle-1', 1)
+        for i in range(4):
+            busy.set(i, i)
+            busy.get(i)
+
+        # the idle storage earns nothing, so it gives up its entries first
+        self.assertEqual(registry.size, 4)
+        self.assertEqual(busy.size, 4)
+        self.assertEqual(idle.size, 0)
+
+        # the busy storage is the only one left, its own LRU order applies
+        busy.set(4, 4)
+        self.assertEqual(busy.size, 4)
+        self.assertRaises(memoizewrapper.storage.CacheMissingError, busy.get, 0)
+        self.assertEqual(busy.get(4), 4)
+
+    def test_thrashing_storage_takes_budget_from_idle_one(self):
+        registry = memoizewrapper.registry.CacheRegistry(max_entries=4)
+        idle = memoizewrapper.storage.LruStorage(capacity=10)
+        cold = memoizewrapper.storage.LruStorage(capacity=10)
+        registry.register(idle)
+        registry.register(cold)
+
+        for i in range(4):
+            idle.set(i, i)
+        for _ in range(3):
+            for i in range(4):
+                idle.get(i)
+
+        # the cold storage misses on a cycle of 3 keys, until it wins the budget
+        for _ in range(50):
+            for i in range(3):
+                try:
+                    cold.get(i)
+                except memoizewrapper.storage.CacheMissingError:
+                    cold.set(i, i)
+
+        self.assertEqual(registry.size, 4)
+        self.assertEqual(cold.size, 3)
+        self.assertEqual(idle.size, 1)
+        self.assertGreater(cold.hits, 100)
+
+    def test_scanning_storage_does_not_win_budget(self):
+        registry = memoizewrapper.registry.CacheRegistry(max_entries=100)
+        cycling = memoizewrapper.storage.LruStorage(capacity=1000)
+        scanning = memoizewrapper.storage.LruStorage(capacity=1000)
+        registry.register(cycling)
+        registry.register(scanning)
+
+        def access(storage, key):
+            try:
+                storage.get(key)
+            except memoizewrapper.storage.CacheMissingError:
+                storage.set(key, key)
+
+        for i in range(8000):
+            access(cycling, i % 80)
+            # the scanning storage never sees a key twice
+            access(scanning, i)
+
+        self.assertEqual(cycling.size, 80)
+        self.assertEqual(scanning.size, 20)
+
+        hits = cycling.hits
+        for i in range(800):
+            access(cycling, i % 80)
+            access(scanning, 8000 + i)
+        self.assertEqual(cycling.hits - hits, 800)
+
+    def test_entry_just_set_is_not_evicted(self):
+        registry = memoizewrapper.registry.CacheRegistry(max_entries=2)
+        busy = memoizewrapper.storage.LruStorage(capacity=10)
+        cold = memoizewrapper.storage.ExpiringStorage()
+        registry.register(busy)
+        registry.register(cold)
+
+        busy.set(0, 0)
+        busy.set(1, 1)
+        for _ in range(10):
+            busy.get(0)
+            busy.get(1)
+
+        cold.set('a', 'a')
+        self.assertEqual(cold.get('a'), 'a')
+        self.assertEqual(busy.size, 1)
+
+    def test_release_memory(self):
+        rss = [100]
+        registry = memoizewrapper.registry.CacheRegistry(rss_limit=50,
+                                                         rss_getter=lambda: rss[0],
+                                                         memory_check_interval=10,
+                                                         pressure_release_ratio=0.5)
+        storage = memoizewrapper.storage.LruStorage(capacity=100)
+        registry.register(storage)
+
+        for i in range(9):
+            storage.set(i, i)
+        self.assertEqual(storage.size, 9)
+
+        # the 10th set checks the memory usage
+        storage.set(9, 9)
+        self.assertEqual(storage.size, 5)
+        self.assertRaises(memoizewrapper.storage.CacheMissingError, storage.get, 0)
+        self.assertEqual(storage.get(9), 9)
+
+        rss[0] = 10
+        self.assertEqual(registry.release_memory(), 0)
+        self.assertEqual(storage.size, 5)
+
+    def test_register_with_decorator(self):
+        registry = memoizewrapper.registry.CacheRegistry(max_entries=2)
+
+        @memoizewrapper.wrapper.lru_memoize(('a',), 10, registry=registry)
+        def identity(a):
+            return a
+
+        @memoizewrapper.wrapper.expiring_memoize(('a',), None, registry=registry)
+        def negative(a):
+            return -a
+
+        identity(1)
+        identity(2)
+        negative(1)
+        self.assertEqual(registry.size, 2)
+
+        registry2 = memoizewrapper.registry.CacheRegistry()
+        self.assertRaises(ValueError, registry2.register, identity._storage)
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, memoizewrapper.registry.CacheRegistry, max_entries=0)
+        self.assertRaises(ValueError, memoizewrapper.registry.CacheRegistry, rss_limit=10)
+        self.assertRaises(ValueError, memoizewrapper.registry.CacheRegistry().release_memory)
+        self.assertRaises(TypeError, memoizewrapper.registry.CacheRegistry().register, object())
+
+
+if __name__ == '__main__':
+    unittest.main()
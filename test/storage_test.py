@@ -1,3 +1,5 @@
+import os
+import threading
 import time
 import unittest
 
@@ -106,6 +108,172 @@ class StorageTest(unittest.TestCase):
         storage.set(test_key, test_value_updated)
         self.assertEqual(storage.get(test_key), test_value_updated)
 
+    def test_expiring_storage_invalidate(self):
+        storage = memoizewrapper.storage.ExpiringStorage()
+
+        storage.set('a', 1, tags=('user:1', 'group:1'))
+        storage.set('b', 2, tags=('user:2', 'group:1'))
+        storage.set('c', 3)
+
+        self.assertEqual(storage.invalidate('user:1'), 1)
+        self.assertRaises(memoizewrapper.storage.CacheMissingError, storage.get, 'a')
+        self.assertEqual(storage.get('b'), 2)
+
+        # re-setting a key replaces its tags
+        storage.set('b', 2)
+        self.assertEqual(storage.invalidate('group:1'), 0)
+        self.assertEqual(storage.get('b'), 2)
+        self.assertEqual(storage.get('c'), 3)
+        self.assertEqual(storage.invalidate('nothing'), 0)
+
+        storage.set('d', 4, tags=('user:4',))
+        storage.delete('d')
+        self.assertEqual(storage.invalidate('user:4'), 0)
+        self.assertEqual(storage._tag_keys, {})
+        self.assertEqual(storage._key_tags, {})
+
+    def test_expiring_storage_invalidate_index_cleanup_on_expiry(self):
+        time_to_live = 1
+        storage = memoizewrapper.storage.ExpiringStorage(expiration=time_to_live)
+
+        storage.set('a', 1, tags=('user:1',))
+        time.sleep(time_to_live + 0.1)
+        self.assertRaises(memoizewrapper.storage.CacheMissingError, storage.get, 'a')
+        self.assertEqual(storage._tag_keys, {})
+        self.assertEqual(storage._key_tags, {})
+
+    def test_expiring_storage_evict(self):
+        now = [0]
+        storage = memoizewrapper.storage.ExpiringStorage(expiration=10, clock=lambda: now[0])
+
+        storage.set('a', 1)
+        storage.set('b', 2)
+        storage.set('c', 3)
+        # re-set data is evicted after the others
+        storage.set('a', 1)
+        storage.evict()
+        self.assertRaises(memoizewrapper.storage.CacheMissingError, storage.get, 'b')
+        self.assertEqual(storage.get('a'), 1)
+
+        # expired data goes first, all at once
+        now[0] = 5
+        storage.set('d', 4, tags=('t',))
+        now[0] = 11
+        storage.evict()
+        self.assertEqual(storage.size, 1)
+        self.assertEqual(storage.get('d'), 4)
+        self.assertEqual(set(storage._key_tags), {'d'})
+
+    def test_storage_unhashable_tag(self):
+        for storage in (memoizewrapper.storage.ExpiringStorage(),
+                        memoizewrapper.storage.LruStorage(capacity=3)):
+            self.assertRaises(TypeError, storage.set, 'a', 1, tags=(['unhashable'],))
+            self.assertEqual(storage.size, 0)
+            self.assertRaises(memoizewrapper.storage.CacheMissingError, storage.get, 'a')
+
+    def test_lru_storage_invalidate(self):
+        storage = memoizewrapper.storage.LruStorage(capacity=2)
+
+        storage.set('a', 1, tags=('user:1',))
+        storage.set('b', 2, tags=('user:1', 'user:2'))
+        self.assertEqual(storage.invalidate('user:1'), 2)
+        self.assertEqual(storage.size, 0)
+        self.assertRaises(memoizewrapper.storage.CacheMissingError, storage.get, 'a')
+        self.assertRaises(memoizewrapper.storage.CacheMissingError, storage.get, 'b')
+        self.assertEqual(storage._tag_keys, {})
+
+        # evicted keys leave the tag index
+        storage.set('a', 1, tags=('user:1',))
+        storage.set('b', 2, tags=('user:2',))
+        storage.set('c', 3, tags=('user:3',))
+        self.assertEqual(storage.invalidate('user:1'), 0)
+        self.assertEqual(set(storage._tag_keys), {'user:2', 'user:3'})
+
+        self.assertEqual(storage.invalidate('user:2'), 1)
+        self.assertEqual(storage.get('c'), 3)
+        storage.set('d', 4)
+        self.assertEqual(storage.size, 2)
+
+        storage.flush()
+        self.assertEqual(storage._tag_keys, {})
+        self.assertEqual(storage._key_tags, {})
+
+    def test_storage_evict_and_counters(self):
+        for storage in (memoizewrapper.storage.ExpiringStorage(),
+                        memoizewrapper.storage.LruStorage(capacity=3)):
+            storage.set('a', 1, tags=('t',))
+            storage.set('b', 2)
+            self.assertEqual(storage.size, 2)
+
+            storage.get('b')
+            self.assertRaises(memoizewrapper.storage.CacheMissingError, storage.get, 'c')
+            self.assertEqual((storage.hits, storage.misses), (1, 1))
+
+            # 'a' was set earliest and used least recently
+            storage.evict()
+            self.assertRaises(memoizewrapper.storage.CacheMissingError, storage.get, 'a')
+            self.assertEqual(storage._tag_keys, {})
+            storage.evict()
+            self.assertEqual(storage.size, 0)
+            self.assertRaises(memoizewrapper.storage.CacheMissingError, storage.evict)
+
+    def test_compressed_storage(self):
+        for codec in ('zlib', 'lzma'):
+            inner = memoizewrapper.storage.LruStorage(capacity=3)
+            storage = memoizewrapper.storage.CompressedStorage(inner, threshold=100, codec=codec, level=1)
+
+            small_value = 'world'
+            large_value = {'rows': ['row'] * 1000}
+            storage.set('small', small_value)
+            storage.set('large', large_value, tags=('t',))
+
+            # small values are stored as they are
+            self.assertIs(inner.get('small'), small_value)
+            self.assertIs(storage.get('small'), small_value)
+            self.assertIsInstance(inner.get('large'), memoizewrapper.storage.CompressedStorage._CompressedValue)
+            self.assertEqual(storage.get('large'), large_value)
+            self.assertIsNot(storage.get('large'), large_value)
+
+            self.assertGreater(storage.compression_ratio, 10)
+            self.assertGreaterEqual(storage.compress_time, 0)
+            self.assertGreaterEqual(storage.decompress_time, 0)
+            self.assertEqual(storage.size, 2)
+            self.assertEqual(storage.hits, inner.hits)
+
+            self.assertEqual(storage.invalidate('t'), 1)
+            self.assertRaises(memoizewrapper.storage.CacheMissingError, storage.get, 'large')
+            storage.delete('small')
+            self.assertRaises(memoizewrapper.storage.CacheMissingError, storage.delete, 'small')
+
+            storage.set('small', small_value)
+            storage.flush()
+            self.assertEqual(storage.size, 0)
+
+        self.assertRaises(ValueError, memoizewrapper.storage.CompressedStorage,
+                          memoizewrapper.storage.ExpiringStorage(), codec='gzip')
+        self.assertRaises(ValueError, memoizewrapper.storage.CompressedStorage,
+                          memoizewrapper.storage.ExpiringStorage(), level=10)
+        self.assertRaises(ValueError, memoizewrapper.storage.CompressedStorage,
+                          memoizewrapper.storage.ExpiringStorage(), codec='lzma', level='high')
+        self.assertRaises(TypeError, memoizewrapper.storage.CompressedStorage, {})
+
+    def test_compressed_storage_incompressible_value(self):
+        inner = memoizewrapper.storage.ExpiringStorage()
+        storage = memoizewrapper.storage.CompressedStorage(inner, threshold=0)
+
+        value = os.urandom(100000)
+        storage.set('random', value)
+        self.assertIs(inner.get('random'), value)
+        self.assertIs(storage.get('random'), value)
+        self.assertEqual(storage.compression_ratio, 1.0)
+
+    def test_compressed_storage_unpicklable_value(self):
+        storage = memoizewrapper.storage.CompressedStorage(memoizewrapper.storage.ExpiringStorage(), threshold=0)
+
+        lock = threading.Lock()
+        storage.set('lock', lock)
+        self.assertIs(storage.get('lock'), lock)
+        self.assertEqual(storage.compression_ratio, 1.0)
 
 if __name__ == '__main__':
     unittest.main()
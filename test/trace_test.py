@@ -0,0 +1,123 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import memoizewrapper.storage
+import memoizewrapper.trace
+import memoizewrapper.wrapper
+
+
+class TraceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.trace_path = os.path.join(self.temp_dir, 'test.trace')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_record_and_read(self):
+        recorder = memoizewrapper.trace.TraceRecorder(self.trace_path, buffer_size=2)
+
+        @memoizewrapper.wrapper.lru_memoize(('a',), 10, trace_recorder=recorder)
+        def identity(a):
+            return a
+
+        for value in (1, 2, 1, 1, 3):
+            identity(value)
+        recorder.close()
+
+        sample_rate, records = memoizewrapper.trace.read_trace(self.trace_path)
+        self.assertEqual(sample_rate, 1.0)
+        self.assertEqual([record.hit for record in records], [False, False, True, True, False])
+        self.assertEqual(records[0].key_hash, records[2].key_hash)
+        self.assertNotEqual(records[0].key_hash, records[1].key_hash)
+        self.assertTrue(all(record.compute_time >= 0 for record in records))
+        self.assertEqual(records[2].compute_time, 0.0)
+
+        # recording after close is ignored
+        identity(4)
+
+    def test_sampling_by_key(self):
+        with memoizewrapper.trace.TraceRecorder(self.trace_path, sample_rate=0.5) as recorder:
+            for i in range(1000):
+                recorder.record(i, False, 0.1)
+                recorder.record(i, True)
+
+        sample_rate, records = memoizewrapper.trace.read_trace(self.trace_path)
+        self.assertEqual(sample_rate, 0.5)
+        self.assertTrue(300 < len(records) / 2 < 700)
+
+        # a key is either fully recorded or not at all
+        hits = set(record.key_hash for record in records if record.hit)
+        misses = set(record.key_hash for record in records if not record.hit)
+        self.assertEqual(hits, misses)
+
+    def test_sampling_by_non_md5_key(self):
+        with memoizewrapper.trace.TraceRecorder(self.trace_path, sample_rate=0.1) as recorder:
+            for i in range(1000):
+                recorder.record(str(i), False, 0.1)
+
+        _, records = memoizewrapper.trace.read_trace(self.trace_path)
+        self.assertTrue(50 < len(records) < 150)
+
+    def test_miss_ratio_curve(self):
+        with memoizewrapper.trace.TraceRecorder(self.trace_path) as recorder:
+            # keys 0, 1, 2 cycled 10 times
+            for _ in range(10):
+                for i in range(3):
+                    recorder.record(i, False, 1.0)
+
+        results = memoizewrapper.trace.miss_ratio_curve(
+            self.trace_path,
+            capacities=(2, 3),
+            expirations=(3600,),
+            storage_factories={'no cache': lambda clock: memoizewrapper.storage.LruStorage(capacity=1)})
+
+        self.assertEqual([(result.storage, result.parameter) for result in results],
+                         [('LruStorage', 2), ('LruStorage', 3), ('ExpiringStorage', 3600), ('no cache', None)])
+
+        lru_2, lru_3, expiring_3600, no_cache = results
+        # LRU thrashes on a cycle bigger than its capacity
+        self.assertEqual(lru_2.misses, 30)
+        self.assertEqual(lru_3.misses, 3)
+        self.assertAlmostEqual(lru_3.miss_ratio, 0.1)
+        self.assertAlmostEqual(lru_3.saved_compute_time, 27.0)
+        self.assertEqual(expiring_3600.misses, 3)
+        self.assertEqual(no_cache.misses, 30)
+
+    def test_command_line(self):
+        with memoizewrapper.trace.TraceRecorder(self.trace_path) as recorder:
+            recorder.record('a', False, 1.0)
+            recorder.record('a', True)
+
+        output = subprocess.check_output([sys.executable, '-m', 'memoizewrapper.trace', self.trace_path,
+                                          '--capacity', '1'],
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertIn(b'LruStorage', output)
+        self.assertIn(b'0.5000', output)
+
+    def test_write_at_exit(self):
+        script = (
+            'import memoizewrapper.trace\n'
+            'recorder = memoizewrapper.trace.TraceRecorder(%r)\n'
+            'for i in range(100):\n'
+            '    recorder.record(i, False, 0.1)\n'
+        ) % self.trace_path
+        subprocess.check_call([sys.executable, '-c', script],
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+        _, records = memoizewrapper.trace.read_trace(self.trace_path)
+        self.assertEqual(len(records), 100)
+
+    def test_read_invalid_trace(self):
+        with open(self.trace_path, 'wb') as trace_file:
+            trace_file.write(b'not a trace')
+        self.assertRaises(ValueError, memoizewrapper.trace.read_trace, self.trace_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
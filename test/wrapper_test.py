@@ -1,9 +1,18 @@
+import concurrent.futures
 import time
 import unittest
+import unittest.mock
 
+import memoizewrapper.keygenerator
+import memoizewrapper.storage
 import memoizewrapper.wrapper
 
 
+@memoizewrapper.wrapper.lru_memoize(('a', 'b'), 10)
+def module_level_sum(a, b):
+    return a + b
+
+
 class WrapperUnittest(unittest.TestCase):
 
     def test_expiring_memoize(self):
@@ -121,6 +130,212 @@ class WrapperUnittest(unittest.TestCase):
         expected_called += 1
         self.assertEqual(called, expected_called)
 
+    def test_lru_memoize_invalidate(self):
+        called = 0
+
+        @memoizewrapper.wrapper.lru_memoize(('user_id', 'field'), 10,
+                                            tag_template=('user_id',),
+                                            tag_generator=lambda x: ['group:%s' % (x % 2)])
+        def get_field(user_id, field):
+            nonlocal called
+            called += 1
+            return user_id
+
+        get_field(1, 'name')
+        get_field(1, 'email')
+        get_field(2, 'name')
+        self.assertEqual(called, 3)
+
+        self.assertEqual(get_field.invalidate(user_id=1), 2)
+        get_field(2, 'name')
+        self.assertEqual(called, 3)
+        get_field(1, 'name')
+        self.assertEqual(called, 4)
+
+        self.assertEqual(get_field.invalidate(tag='group:0'), 1)
+        get_field(2, 'name')
+        self.assertEqual(called, 5)
+
+        self.assertEqual(get_field.invalidate(user_id=3), 0)
+        self.assertRaises(ValueError, get_field.invalidate, field='name')
+
+    def test_expiring_memoize_invalidate_default_argument(self):
+        expiration = 5
+        called = 0
+
+        @memoizewrapper.wrapper.expiring_memoize(('a', 'b'), expiration, tag_template=('b',))
+        def sum_int(a, b=1):
+            nonlocal called
+            called += 1
+            return a + b
+
+        self.assertEqual(sum_int(1, b=1), 2)
+        self.assertEqual(sum_int(2, 2), 4)
+        self.assertEqual(called, 2)
+
+        self.assertEqual(sum_int.invalidate(b=1), 1)
+        self.assertEqual(sum_int(2, 2), 4)
+        self.assertEqual(called, 2)
+        self.assertEqual(sum_int(1, b=1), 2)
+        self.assertEqual(called, 3)
+
+    def test_memoize_string_tag_generator(self):
+        @memoizewrapper.wrapper.lru_memoize(('a',), 1, tag_generator=lambda x: 'team:x')
+        def identity(a):
+            return a
+
+        self.assertRaises(TypeError, identity, 1)
+
+    def test_memoize_unhashable_tag(self):
+        called = 0
+
+        @memoizewrapper.wrapper.lru_memoize(('a',), 10, tag_template=('a',))
+        def length(a):
+            nonlocal called
+            called += 1
+            return len(a)
+
+        self.assertRaises(TypeError, length, [1, 2])
+        self.assertRaises(TypeError, length, [1, 2])
+        # nothing was stored
+        self.assertEqual(called, 2)
+        self.assertEqual(length._storage.size, 0)
+
+    def test_memoize_invalid_tag_template(self):
+        self.assertRaises(ValueError, memoizewrapper.wrapper.lru_memoize(('a',), 1, tag_template=('c',)),
+                          lambda a: a)
+
+    def test_lru_memoize_map(self):
+        called = []
+
+        @memoizewrapper.wrapper.lru_memoize(('value',), 10, escape_cache_if=lambda x: x == 'skip')
+        def return_same(value):
+            called.append(value)
+            return value
+
+        return_same('hit')
+        del called[:]
+
+        test_data = ['a', 'hit', 'b', 'a', 'skip', 'b', 'hit', 'skip']
+        self.assertEqual(list(return_same.map(test_data)), test_data)
+        # hits and duplicates are not computed
+        self.assertEqual(called, ['a', 'b', 'skip'])
+
+        # stored, except the escaped one
+        self.assertEqual(list(return_same.map(['a', 'b', 'skip'])), ['a', 'b', 'skip'])
+        self.assertEqual(called, ['a', 'b', 'skip', 'skip'])
+
+    def test_expiring_memoize_map_with_thread_pool(self):
+        expiration = 5
+        called = []
+
+        @memoizewrapper.wrapper.expiring_memoize(('a', 'b'), expiration, tag_template=('a',))
+        def sum_int(a, b):
+            called.append((a, b))
+            return a + b
+
+        test_a = [i % 3 for i in range(100)]
+        test_b = [i % 5 for i in range(100)]
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            results = sum_int.map(test_a, test_b, executor=executor)
+            self.assertEqual(list(results), [a + b for a, b in zip(test_a, test_b)])
+        self.assertEqual(sorted(called), sorted(set(zip(test_a, test_b))))
+
+        # stored with tags
+        self.assertEqual(sum_int.invalidate(a=0), 5)
+
+    def test_lru_memoize_map_with_process_pool(self):
+        test_a = [1, 2, 1, 3]
+        test_b = [1, 2, 1, 3]
+        with concurrent.futures.ProcessPoolExecutor(2) as executor:
+            results = module_level_sum.map(test_a, test_b, executor=executor, chunksize=2)
+            self.assertEqual(list(results), [2, 4, 2, 6])
+
+        self.assertEqual(module_level_sum._storage.size, 3)
+
+    def test_lru_memoize_map_trace_order(self):
+        recorder = unittest.mock.Mock()
+
+        @memoizewrapper.wrapper.lru_memoize(('value',), 10, trace_recorder=recorder)
+        def return_same(value):
+            return value
+
+        return_same('hit')
+        recorder.reset_mock()
+
+        self.assertEqual(list(return_same.map(['a', 'hit', 'a'])), ['a', 'hit', 'a'])
+        self.assertEqual([(call[0][0], call[0][1]) for call in recorder.record.call_args_list],
+                         [(return_same._key_generator.generate_key(value), hit)
+                          for value, hit in (('a', False), ('hit', True), ('a', True))])
+
+    def test_lru_memoize_method(self):
+        called = []
+
+        class Card(object):
+            def __init__(self, prefix):
+                self.prefix = prefix
+
+            @memoizewrapper.wrapper.lru_memoize(('card_id',), 10, tag_template=('card_id',))
+            def name(self, card_id):
+                called.append(card_id)
+                return self.prefix + str(card_id)
+
+        card = Card('card-')
+        self.assertEqual(card.name(1), 'card-1')
+        self.assertEqual(list(card.name.map([1, 2, 2])), ['card-1', 'card-2', 'card-2'])
+        self.assertEqual(called, [1, 2])
+
+        self.assertEqual(card.name.invalidate(card_id=2), 1)
+        self.assertEqual(Card.name(card, 2), 'card-2')
+        self.assertEqual(called, [1, 2, 2])
+
+        card.name.flush()
+        self.assertEqual(card.name(1), 'card-1')
+        self.assertEqual(called, [1, 2, 2, 1])
+        self.assertRaises(TypeError, card.name.map)
+
+    def test_stacked_memoize(self):
+        called = 0
+
+        @memoizewrapper.wrapper.lru_memoize(('a',), 1)
+        @memoizewrapper.wrapper.expiring_memoize(('a',), None)
+        def identity(a):
+            nonlocal called
+            called += 1
+            return a
+
+        for value in (1, 2, 3, 1):
+            self.assertEqual(identity(value), value)
+        # 1 was evicted from the outer cache, but the inner cache still has it
+        self.assertEqual(called, 3)
+
+    def test_memoize_compressed_storage(self):
+        called = 0
+
+        @memoizewrapper.wrapper.memorize_wrapper(
+            memoizewrapper.keygenerator.TupleKeyGenerator(template=('n',)),
+            memoizewrapper.storage.CompressedStorage(memoizewrapper.storage.LruStorage(capacity=2), threshold=10),
+        )
+        def repeat(n):
+            nonlocal called
+            called += 1
+            return 'x' * n
+
+        self.assertEqual(repeat(1000), 'x' * 1000)
+        self.assertEqual(repeat(1000), 'x' * 1000)
+        self.assertEqual(called, 1)
+        self.assertGreater(repeat._storage.compression_ratio, 10)
+
+        @memoizewrapper.wrapper.memorize_wrapper(
+            memoizewrapper.keygenerator.TupleKeyGenerator(template=('n',)),
+            memoizewrapper.storage.CompressedStorage(memoizewrapper.storage.LruStorage(capacity=2), threshold=0),
+        )
+        def counter(n):
+            return (i for i in range(n))
+
+        generator = counter(3)
+        self.assertIs(counter(3), generator)
+
 
 if __name__ == '__main__':
     unittest.main()